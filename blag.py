@@ -5,6 +5,8 @@ import json
 import jinja2
 import datetime
 import time
+import itertools
+import urllib
 import markupsafe
 import logging
 from markupsafe import Markup, escape
@@ -16,49 +18,164 @@ jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
                                autoescape = True)
 sys.path.append(os.path.join(os.path.dirname(__file__), 'lib'))
 
-import markdown2
 import auth_helpers
 import valid_helpers
+import json_helpers
+import storage
+import cache_helpers
+import invalidation
+import tasks
+import markdown_helpers
+from cache_helpers import cached, cached_multi, ENTRY_TTL
+
+POSTS_PER_PAGE = 20
+QUOTES_PER_PAGE = 10
+# how long a post id that doesn't exist is remembered as missing
+MISSING_POST_TTL = 60
+JSON_BATCH_SIZE = 100
+JSON_MAX_LIMIT = 100
+JSON_FIELDS = ('subject', 'content', 'created', 'last_modified')
+FEED_SIZE = 20
 
 ### CACHE HELPERS ###
-def get_top_posts(update = False):
-    key = 'top'
-    posts = memcache.get(key)
-    if posts is None or update:
-        posts = db.GqlQuery("SELECT * FROM Post WHERE is_draft = FALSE AND is_quote = FALSE ORDER BY created DESC")
-        posts = list(posts)
-        memcache.set(key, posts)
-    return posts
-
-def get_top_quotes(update = False):
-    key = 'quote'
-    posts = memcache.get(key)
-    if posts is None or update:
-        posts = db.GqlQuery("SELECT * FROM Post WHERE is_draft = FALSE AND is_quote = TRUE ORDER BY created DESC")
-        posts = list(posts)
-        memcache.set(key, posts)
-    return posts
+# listings are cached one page at a time as (posts, next_cursor); the post
+# listing only keeps storage.PostSummary records, quotes need their content
+def page_key(namespace, cursor):
+    if not storage.decode_cursor(cursor):
+        cursor = ''
+    return invalidation.versioned_key(namespace, cursor)
+
+def get_top_posts(cursor = None, update = False):
+    def build():
+        return post_repo.list_summary_page(POSTS_PER_PAGE, cursor,
+                                           is_draft = False, is_quote = False)
+    return cached(page_key('top', cursor), build, ENTRY_TTL, update)
+
+def get_top_quotes(cursor = None, update = False):
+    def build():
+        quotes, next_cursor = post_repo.list_page(QUOTES_PER_PAGE, cursor,
+                                                  is_draft = False, is_quote = True)
+        return [fresh_post(q) for q in quotes], next_cursor
+    key = page_key('quote', cursor)
+    quotes, next_cursor = cached(key, build, ENTRY_TTL, update)
+    if any(markdown_helpers.is_stale(q) for q in quotes):
+        # cached before a renderer upgrade
+        quotes, next_cursor = cached(key, build, ENTRY_TTL, update = True)
+    return quotes, next_cursor
 
 def get_requested_post(post_id):
-    my_post = memcache.get(post_id)
-    if my_post is None:
-        my_post = Post.get_by_id(int(post_id))
-        memcache.set(post_id, my_post)
+    """The post, or None if there is no such post (remembered for a while)."""
+    # "/post/01" is post 1: key everything by the canonical id, which is
+    # what invalidation deletes
+    post_id = str(int(post_id))
+    def build():
         memcache.set("(post_time, %s)" % post_id, time.time())
+        return fresh_post(post_repo.get(post_id))
+    my_post = cached(invalidation.post_entity_key(post_id), build,
+                     missing_ttl = MISSING_POST_TTL)
+    if my_post is not None and markdown_helpers.is_stale(my_post):
+        # cached before a renderer upgrade; storage may already have been
+        # re-rendered (see tools/rerender.py), so move the entity and its
+        # pages on to a new version together
+        invalidation.invalidate_rendering(post_id)
+        my_post = cached(invalidation.post_entity_key(post_id), build,
+                         missing_ttl = MISSING_POST_TTL)
     return my_post
 
+def get_posts(post_ids):
+    """get_requested_post() for many ids: one memcache and one storage call.
+
+    Returns posts (None where there is no such post) lined up with post_ids.
+    """
+    ids = [str(post_id) for post_id in post_ids]
+    keys = dict((invalidation.post_entity_key(post_id), post_id) for post_id in ids)
+    def build(missing):
+        found = post_repo.get_multi([keys[key] for key in missing])
+        return dict(zip(missing, [fresh_post(p) for p in found]))
+    posts = cached_multi(list(keys), build, missing_ttl = MISSING_POST_TTL)
+    posts = dict((keys[key], post) for key, post in posts.items())
+    return [get_requested_post(post_id)
+            if posts[post_id] is not None and markdown_helpers.is_stale(posts[post_id])
+            else posts[post_id] for post_id in ids]
+
+def fresh_post(my_post):
+    """my_post, re-rendered first if a newer renderer has been deployed.
+
+    The new HTML is saved back, so each post is re-rendered once per
+    upgrade, when it is first read after it.
+    """
+    if my_post is not None and markdown_helpers.refresh(my_post):
+        post_repo.save_rendering(my_post)
+        invalidation.invalidate_rendering(my_post.key().id())
+        invalidation.renderer_changed(markdown_helpers.RENDERER_VERSION)
+    return my_post
+
+# rendered pages share the invalidation of the data they show
+def page_html_key(namespace, cursor, path, logged_in):
+    return page_key(namespace, cursor) + "|html|%s|%d" % (path, logged_in)
+
 ### BASE HANDLER CLASS ###
 class Handler(webapp2.RequestHandler):
     def write(self, *a, **kw):
         self.response.out.write(*a, **kw)
 
     def render_str(self, template, **params):
-        t = jinja_env.get_template(template)
-        return t.render(params)
+        return render_str(template, **params)
 
     def render(self, template, **kw):
         self.write(self.render_str(template, **kw))
 
+    def not_modified(self, etag, last_modified = None):
+        """Set the validators and answer 304 if the client's copy is current.
+
+        Meant to run before any query or rendering: when it returns True the
+        response is done.
+        """
+        self.response.headers['ETag'] = etag
+        if last_modified:
+            self.response.last_modified = last_modified
+        if 'If-None-Match' in self.request.headers:
+            fresh = etag.strip('"') in self.request.if_none_match
+        else:
+            since = self.request.if_modified_since
+            fresh = bool(last_modified and since and
+                         since.replace(tzinfo = None) >= last_modified.replace(microsecond = 0))
+        if fresh:
+            self.response.status = 304
+        return fresh
+
+    def content_encoding(self):
+        """The precompressed encoding to send, None for the plain body."""
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        # webob treats a missing header as "anything goes"; don't
+        if 'Accept-Encoding' not in self.request.headers:
+            return None
+        return self.request.accept_encoding.best_match(cache_helpers.ENCODINGS)
+
+    def write_page(self, page, encoding = None):
+        if encoding:
+            self.response.headers['Content-Encoding'] = encoding
+            self.write(page.encoded[encoding])
+        else:
+            self.write(page.body)
+
+    def render_cached(self, key, render, last_modified = None, ttl = ENTRY_TTL,
+                      private = False):
+        """Write the page cached at key; render() builds its HTML on a miss.
+
+        private pages differ with the login cookie: their key (and so their
+        ETag) says which copy it is, but a date can't, so they go without
+        Last-Modified and are kept out of shared caches.
+        """
+        encoding = self.content_encoding()
+        if private:
+            self.response.headers['Cache-Control'] = 'private'
+            self.response.headers['Vary'] = 'Accept-Encoding, Cookie'
+            last_modified = None
+        if self.not_modified(cache_helpers.etag_for(key, encoding), last_modified):
+            return
+        self.write_page(cache_helpers.cached_page(key, render, ttl), encoding)
+
     def logged_in(self):
         cookie_val = self.request.cookies.get("logged_in")
         if cookie_val:
@@ -98,37 +215,128 @@ class LogoutHandler(Handler):
 class Post(db.Model):
     subject = db.StringProperty(required = True)
     content = db.TextProperty(required = True)
+    source = db.TextProperty()
+    renderer = db.IntegerProperty()
     created = db.DateTimeProperty(auto_now_add = True)
     last_modified = db.DateTimeProperty(auto_now_add = True)
     is_draft = db.BooleanProperty()
     is_quote = db.BooleanProperty(required = True)
 
+post_repo = storage.make_repository(Post)
+
+### PAGES ###
+def render_str(template, **params):
+    t = jinja_env.get_template(template)
+    return t.render(params)
+
+# Public pages as (cache key, render function) pairs, shared by the
+# handlers and warm_caches()
+def listing_page(template, path, cursor, logged_in):
+    def render():
+        posts, next_cursor = get_top_posts(cursor)
+        return render_str(template, posts=posts, next_cursor = next_cursor)
+    return page_html_key('top', cursor, path, logged_in), render
+
+def quotes_page(path, cursor, logged_in):
+    def render():
+        quotes, next_cursor = get_top_quotes(cursor)
+        return render_str("quotes.html", quotes = quotes, next_cursor = next_cursor,
+                                         logged_in = logged_in)
+    return page_html_key('quote', cursor, path, logged_in), render
+
+def post_page(my_post, logged_in):
+    def render():
+        return render_str("showpost.html", my_post = my_post, logged_in = logged_in)
+    return invalidation.post_page_key(my_post.key().id(), logged_in), render
+
+def post_json_page(my_post):
+    def render():
+        return json.dumps(post_dict(my_post), indent=4)
+    return invalidation.post_json_key(my_post.key().id()), render
+
 class MainPage(Handler):
     def get(self):
-        posts = get_top_posts() 
-        self.render("home.html", posts=posts)
+        self.render_cached(*listing_page("home.html", self.request.path,
+                                         self.request.get('cursor'), self.logged_in()),
+                           private = True)
 
 class BlogHandler(Handler):
     def get(self):
-        posts = get_top_posts() 
-        self.render("archives.html", posts=posts)
+        self.render_cached(*listing_page("archives.html", self.request.path,
+                                         self.request.get('cursor'), self.logged_in()),
+                           private = True)
 
 class QuotesHandler(Handler):
     def get(self):
-        quotes = get_top_quotes()
-        self.render("quotes.html", quotes = quotes)
+        self.render_cached(*quotes_page(self.request.path, self.request.get('cursor'),
+                                        self.logged_in()),
+                           private = True)
+
+def post_dict(my_post, fields = JSON_FIELDS):
+    d = {}
+    for field in fields:
+        value = getattr(my_post, field)
+        if field in ('created', 'last_modified'):
+            value = value.strftime('%a %b %d %H:%M:%S %Y')
+        d[field] = value
+    return d
 
 class JsonPostHandler(Handler):
+    # /.json?limit=&cursor=&fields=subject,created
+    # Without limit every post is exported; posts are read in batches and
+    # written out as they are encoded, so memory is bounded by
+    # JSON_BATCH_SIZE rather than by the archive. With limit one page is
+    # returned and a Link header points to the next one. Only the requested
+    # fields are read from storage.
     def get(self):
         self.response.headers['Content-type'] = 'application/json'
-        posts = db.GqlQuery("SELECT * FROM Post WHERE is_draft = FALSE ORDER BY created DESC")
-        post_dict = []
-        for my_post in posts:
-            post_dict.append({"subject" : my_post.subject, "content" : my_post.content, 
-                            "created" : my_post.created.strftime('%a %b %d %H:%M:%S %Y'),
-                            "last_modified" : my_post.last_modified.strftime('%a %b %d %H:%M:%S %Y')})
+        indent = None if self.request.get('compact') else 4
+        fields = self.request.get('fields')
+        fields = fields and tuple(fields.split(',')) or JSON_FIELDS
+        limit = self.request.get('limit')
+        cursor = self.request.get('cursor')
+        if not storage.decode_cursor(cursor):
+            cursor = ''
+        if [f for f in fields if f not in JSON_FIELDS]:
+            self.abort(400)
+        if limit:
+            try:
+                limit = int(limit)
+            except ValueError:
+                self.abort(400)
+            if limit < 1:
+                self.abort(400)
+            limit = min(limit, JSON_MAX_LIMIT)
 
-        self.write(json.dumps(post_dict, indent=4))
+        key = invalidation.versioned_key('json', ','.join(fields), str(limit or ''),
+                                         cursor, str(indent))
+        if self.not_modified(cache_helpers.etag_for(key)):
+            return
+        # content may need re-rendering, which needs the source
+        read_fields = fields
+        if 'content' in fields:
+            read_fields += ('source', 'renderer')
+        if limit:
+            posts, next_cursor = post_repo.list_page(limit, cursor, is_draft = False,
+                                                     fields = read_fields)
+            if next_cursor:
+                # only what was validated above; anything else in the query
+                # string is ignored and needn't survive urlencode()
+                params = dict(limit = limit, cursor = next_cursor)
+                if self.request.get('fields'):
+                    params['fields'] = ','.join(fields)
+                if self.request.get('compact'):
+                    params['compact'] = 1
+                self.response.headers['Link'] = '<%s?%s>; rel="next"' % (
+                    self.request.path_url, urllib.urlencode(sorted(params.items())))
+        else:
+            posts = post_repo.iter_posts(JSON_BATCH_SIZE, is_draft = False,
+                                         fields = read_fields)
+        if 'content' in fields:
+            posts = itertools.imap(fresh_post, posts)
+        dicts = itertools.imap(lambda p: post_dict(p, fields), posts)
+        for chunk in json_helpers.iter_json_array(dicts, indent):
+            self.write(chunk)
 
 class NewPostHandler(Handler):
     def get(self):
@@ -139,103 +347,221 @@ class NewPostHandler(Handler):
 
     def post(self):
         if self.logged_in():
-            self.render("newpost.html")
             subject = self.request.get("subject")
-            content = Markup(markdown2.markdown(self.request.get("content")))
+            source = self.request.get("content")
             is_quote = self.request.get("is_quote")
             is_draft = self.request.get("is_draft")
             
-            if subject and content:
-                p = Post(subject = subject, content = content,
-                        is_draft = (is_draft == "on"),
-                        is_quote = (is_quote == "on"))
-                p.put()
+            if subject and source:
+                p = post_repo.create(subject = subject,
+                                     content = markdown_helpers.render(source),
+                                     source = source,
+                                     renderer = markdown_helpers.RENDERER_VERSION,
+                                     is_draft = (is_draft == "on"),
+                                     is_quote = (is_quote == "on"))
+                post_repo.put(p)
+                invalidation.invalidate_post(p, is_new = True)
+                post_written()
                 if is_draft == "on":
                     self.redirect('/drafts')
                 elif is_quote == "on":
-                    get_top_quotes(update = True)
                     self.redirect('/quotes')
                 else:
-                    get_top_posts(update = True)
                     self.redirect('/')
             else:
                 error = "Both subject and content please!"
-                self.render("newpost.html", subject = subject, content = content, error = error)
+                self.render("newpost.html", subject = subject, content = source, error = error)
         else:
             self.abort(403)
 
 class ShowPostHandler(Handler):
     def get(self, post_id):
         my_post = get_requested_post(post_id)
-        self.render("showpost.html", my_post = my_post, 
-                                     logged_in = self.logged_in())
+        if my_post is None:
+            self.abort(404)
+        key, render = post_page(my_post, self.logged_in())
+        self.render_cached(key, render, private = True)
 
 class ShowPostJsonHandler(Handler):
+    # shares the entity cache with ShowPostHandler and keeps the encoded
+    # JSON under the post's version
     def get(self, post_id):
+        my_post = get_requested_post(post_id)
+        if my_post is None:
+            self.abort(404)
         self.response.headers['Content-type'] = 'application/json'
-        my_post = Post.get_by_id(int(post_id))
-        post_dict = {"subject" : my_post.subject, "content" : my_post.content, 
-                    "created" : my_post.created.strftime('%a %b %d %H:%M:%S %Y'),
-                    "last_modified" : my_post.last_modified.strftime('%a %b %d %H:%M:%S %Y')}
-        self.write(json.dumps(post_dict, indent=4))
+        key, render = post_json_page(my_post)
+        self.render_cached(key, render, my_post.last_modified)
 
 class EditPostHandler(Handler):
     def get(self, post_id):
         if self.logged_in():
-            my_post = Post.get_by_id(int(post_id))
-            self.render("editpost.html", subject = my_post.subject, content = my_post.content)
+            my_post = post_repo.get(post_id)
+            # posts from before sources were kept can only be edited as HTML
+            self.render("editpost.html", subject = my_post.subject,
+                        content = my_post.source or my_post.content)
         else:
             self.abort(403)
 
     def post(self, post_id):
         if self.logged_in():
             subject = self.request.get("subject")
-            content = Markup(markdown2.markdown(self.request.get("content")))
+            source = self.request.get("content")
             last_modified = datetime.datetime.now()
             is_draft = self.request.get("is_draft")
             
-            if subject and content:
-                my_post = Post.get_by_id(int(post_id))
+            if subject and source:
+                my_post = post_repo.get(post_id)
+                was_public = not my_post.is_draft
                 my_post.subject = subject
-                my_post.content = content
+                my_post.content = markdown_helpers.render(source)
+                my_post.source = source
+                my_post.renderer = markdown_helpers.RENDERER_VERSION
                 my_post.is_draft = (is_draft == "on")
-                my_post.put()
+                my_post.last_modified = last_modified
+                post_repo.put(my_post)
+                invalidation.invalidate_post(my_post, was_public)
+                post_written()
 
                 if is_draft == "on":
                     self.redirect('/drafts')
                 else:
-                    memcache.flush_all()
                     self.redirect('/')
                     self.redirect('/post/' + str(my_post.key().id()))
             else:
                 error = "Both subject and content please!"
-                self.render("editpost.html", subject = subject, content = content, error = error)
+                self.render("editpost.html", subject = subject, content = source, error = error)
         else:
             self.abort(403)
 
 class DraftHandler(Handler):
     def get(self):
-        posts = db.GqlQuery("SELECT * FROM Post WHERE is_draft = TRUE ORDER BY created DESC")
-        self.render("main.html", posts=posts)
+        posts = post_repo.list_posts(is_draft = True)
+        self.render("main.html", posts=map(fresh_post, posts))
 
 class DeletePostHandler(Handler):
     def get(self, post_id):
         if self.logged_in():
-            my_post = Post.get_by_id(int(post_id))
-            my_post.delete()
-            self.redirect('/flush')
+            my_post = post_repo.get(post_id)
+            if my_post:
+                post_repo.delete(post_id)
+                invalidation.invalidate_post(my_post)
+                post_written()
+            self.redirect('/')
         else:
             self.abort(403)
 
+### FEEDS ###
+# RFC 5005 archived feeds: the current feed carries every post of the
+# current month and a prev-archive link to monthly archive documents. A
+# month's archive is sealed once the month is over; from then on it is
+# cached with no expiry.
+def month_start(dt):
+    return datetime.datetime(dt.year, dt.month, 1)
+
+def next_month(start):
+    if start.month == 12:
+        return datetime.datetime(start.year + 1, 1, 1)
+    return datetime.datetime(start.year, start.month + 1, 1)
+
+def prev_archive(before):
+    """The archive month ("YYYY-MM") of the newest post before a date."""
+    posts = post_repo.list_range(None, before, limit = 1, is_draft = False)
+    return posts and posts[0].created.strftime('%Y-%m') or None
+
+def render_feed(posts, **params):
+    posts = [fresh_post(p) for p in posts]
+    if posts:
+        updated = max(p.last_modified for p in posts)
+    else:
+        updated = datetime.datetime.now()
+    return render_str("xmltemplate.xml", posts=posts, updated = updated, **params)
+
+def feed_page(this_month):
+    def render():
+        posts = post_repo.list_range(this_month, None, is_draft = False)
+        if len(posts) < FEED_SIZE:
+            # early in the month, top up with the newest older posts; they
+            # are in their archives as well, readers merge entries by id
+            posts, next_cursor = post_repo.list_page(FEED_SIZE, is_draft = False)
+        return render_feed(posts, prev_archive = prev_archive(this_month))
+    # the month is in the key because prev-archive moves when it ends
+    return invalidation.versioned_key('feed', 'atom', this_month.strftime('%Y-%m')), render
+
 class XMLHandler(Handler):
+    # the feed only changes when a published post does, which bumps the
+    # 'feed' version, so a poll costs one cache read
     def get(self):
-        posts = db.GqlQuery("SELECT * FROM Post WHERE is_draft = FALSE ORDER BY created DESC")
         self.response.headers['Content-Type'] = 'application/atom+xml'
-        self.render("xmltemplate.xml", posts=posts)
+        self.render_cached(*feed_page(month_start(datetime.datetime.now())))
+
+class FeedArchiveHandler(Handler):
+    def get(self, year, month):
+        try:
+            start = datetime.datetime(int(year), int(month), 1)
+        except ValueError:
+            self.abort(404)
+        end = next_month(start)
+        if end > datetime.datetime.now():
+            # not sealed yet, those posts are in the current feed
+            self.abort(404)
+        archive = start.strftime('%Y-%m')
+        def has_posts():
+            return bool(post_repo.list_range(start, end, limit = 1, is_draft = False))
+        if not cached(invalidation.versioned_key('archive', archive, 'exists'), has_posts):
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/atom+xml'
+        self.response.headers['Cache-Control'] = 'public, max-age=31536000'
+        def render():
+            posts = post_repo.list_range(start, end, is_draft = False)
+            return render_feed(posts, archive = archive,
+                               prev_archive = prev_archive(start))
+        self.render_cached(invalidation.versioned_key('archive', archive), render, ttl = 0)
+
+### WARM-UP ###
+WARM_POSTS = 10
+
+def warm_caches():
+    """Fill whatever the anonymous front pages need that isn't cached yet.
+
+    Runs when an instance starts and in the background after every write.
+    """
+    # a deploy with a new renderer retires the listings rendered by the old
+    invalidation.renderer_changed(markdown_helpers.RENDERER_VERSION)
+    for key, render in [listing_page("home.html", '/', None, False),
+                        listing_page("archives.html", '/blog', None, False),
+                        quotes_page('/quotes', None, False),
+                        feed_page(month_start(datetime.datetime.now()))]:
+        cache_helpers.cached_page(key, render)
+    posts, next_cursor = get_top_posts()
+    for my_post in get_posts([p.id for p in posts[:WARM_POSTS]]):
+        if my_post is not None:
+            cache_helpers.cached_page(*post_page(my_post, False))
+            cache_helpers.cached_page(*post_json_page(my_post))
+
+### POST-WRITE PIPELINE ###
+# Work that follows a write but that the author shouldn't wait for: the
+# handlers only make the post durable and invalidate, then queue these.
+# Each task is queued on its own so they can run in parallel.
+POST_WRITE_TASKS = [warm_caches]
+
+def post_written():
+    for task in POST_WRITE_TASKS:
+        tasks.enqueue(task)
+
+class WarmupHandler(Handler):
+    # App Engine calls /_ah/warmup before an instance takes traffic (nobody
+    # else can reach /_ah/); /warm is the same thing for the admin
+    def get(self):
+        if self.request.path != '/_ah/warmup' and not self.logged_in():
+            self.abort(403)
+        warm_caches()
+        self.redirect('/')
 
 class FlushCacheHandler(Handler):
+    # retires every listing; posts' own entries stay valid and are kept
     def get(self):
-        memcache.flush_all()
+        invalidation.invalidate_listings()
         self.redirect('/')
        
 app = webapp2.WSGIApplication([('/', MainPage),
@@ -250,5 +576,8 @@ app = webapp2.WSGIApplication([('/', MainPage),
                                ('/post/(\d+)/edit', EditPostHandler),
                                ('/post/(\d+)/delete', DeletePostHandler),
                                ('/feeds/all.atom.xml', XMLHandler),
+                               ('/feeds/archive/(\d{4})-(\d{2}).atom.xml', FeedArchiveHandler),
                                ('/flush', FlushCacheHandler),
+                               ('/warm', WarmupHandler),
+                               ('/_ah/warmup', WarmupHandler),
                                ('/drafts',DraftHandler)], debug=True)
@@ -0,0 +1,238 @@
+import time
+import zlib
+import hashlib
+import logging
+import threading
+import collections
+from google.appengine.api import memcache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Two cache tiers: a small LRU inside each instance in front of memcache,
+# which is shared by all instances. Writes bump a generation counter in
+# memcache and every instance drops its local tier once it sees the bump.
+
+GENERATION_KEY = 'generation'
+# how often (seconds) an instance looks at the shared generation counter,
+# i.e. how stale the local tier can be after a write on another instance
+GENERATION_CHECK = 1
+
+# default lifetime of versioned entries, see invalidation.py
+ENTRY_TTL = 24 * 60 * 60
+
+# single-flight refills, see cached()
+LEASE_TTL = 10
+LEASE_WAIT = 0.05
+LEASE_TRIES = 40
+STALE_GRACE = 5 * 60
+
+class LocalCache(object):
+    """Bounded, thread-safe LRU whose entries expire after ttl seconds."""
+    def __init__(self, max_size = 500, ttl = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = None
+        self.checked = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return None
+            # re-inserting moves the key to the young end
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, ttl = None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + (ttl or self.ttl))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def sync(self, generation):
+        """Forget everything if the shared generation has moved."""
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+local_cache = LocalCache()
+
+def check_generation():
+    now = time.time()
+    if now - local_cache.checked >= GENERATION_CHECK:
+        local_cache.sync(memcache.get(GENERATION_KEY))
+        local_cache.checked = now
+
+def bump_generation():
+    # if the counter was flushed or evicted it restarts from the clock, so
+    # it never comes back to a value some instance has already seen
+    generation = memcache.incr(GENERATION_KEY,
+                               initial_value = int(time.time() * 1000))
+    local_cache.sync(generation)
+
+### MEMCACHE WRAPPERS ###
+def cache_get(key):
+    check_generation()
+    value = local_cache.get(key)
+    if value is None:
+        value = memcache.get(key)
+        if value is not None:
+            local_cache.set(key, value)
+    return value
+
+def cache_set(key, value, time = 0):
+    memcache.set(key, value, time = time)
+    local_cache.set(key, value, time or None)
+
+def cache_delete(key):
+    memcache.delete(key)
+    local_cache.delete(key)
+
+### SINGLE-FLIGHT REFILLS ###
+# cached() keeps (value, fresh_until) under the key. When a value goes stale
+# or is missing, the first request to win a lease (memcache.add is atomic
+# across instances) rebuilds it. Everyone else serves the stale value, or,
+# on a cold miss, waits for the lease holder to fill the key, so one expiry
+# costs the backend one rebuild instead of one per concurrent request.
+
+def lease_key(key):
+    return "lease|%s" % key
+
+def _refill(key, build, ttl, missing_ttl, leased = True):
+    try:
+        value = build()
+        if value is None and missing_ttl:
+            ttl = missing_ttl
+        fresh_until = ttl and time.time() + ttl
+        # stale values outlive fresh_until for a while so they can be served
+        # while the rebuild runs
+        cache_set(key, (value, fresh_until), time = ttl and ttl + STALE_GRACE)
+        return value
+    finally:
+        # a lease somebody else holds is theirs to release
+        if leased:
+            memcache.delete(lease_key(key))
+
+def cached(key, build, ttl = 0, update = False, missing_ttl = None):
+    """The value cached at key, built with build() if it is stale or missing.
+
+    ttl is in seconds, 0 means the value stays fresh until evicted. update
+    forces a rebuild, e.g. to refresh a key right after a write. A None from
+    build() is cached too, as a tombstone that lives missing_ttl seconds if
+    that is given, so lookups of things that don't exist stay cheap.
+    """
+    if update:
+        # rebuilds whether or not it gets the lease, but only holds the
+        # others off while it does have it
+        leased = memcache.add(lease_key(key), 1, time = LEASE_TTL)
+        return _refill(key, build, ttl, missing_ttl, leased)
+
+    entry = cache_get(key)
+    if entry is not None:
+        value, fresh_until = entry
+        if not fresh_until or fresh_until > time.time():
+            return value
+        if memcache.add(lease_key(key), 1, time = LEASE_TTL):
+            return _refill(key, build, ttl, missing_ttl)
+        return value
+
+    if memcache.add(lease_key(key), 1, time = LEASE_TTL):
+        return _refill(key, build, ttl, missing_ttl)
+    for i in range(LEASE_TRIES):
+        time.sleep(LEASE_WAIT)
+        entry = memcache.get(key)
+        if entry is not None:
+            local_cache.set(key, entry)
+            return entry[0]
+    # the lease holder is slow or died; build without storing the result
+    logging.warning("gave up waiting for the lease on %s", key)
+    return build()
+
+def cached_multi(keys, build_multi, ttl = 0, missing_ttl = None):
+    """Batch cached(): a dict of key -> value for keys.
+
+    Whatever the local tier doesn't have is read with one get_multi, and the
+    rest is built with a single build_multi(missing_keys) call, which returns
+    a dict of key -> value (None for things that don't exist). There is no
+    lease here, batch callers are expected to be rare compared to cached().
+    """
+    check_generation()
+    now = time.time()
+    found = {}
+    for key in keys:
+        entry = local_cache.get(key)
+        if entry is not None:
+            found[key] = entry
+    remote = memcache.get_multi([key for key in keys if key not in found])
+    for key, entry in remote.items():
+        local_cache.set(key, entry)
+    found.update(remote)
+
+    values = {}
+    for key, (value, fresh_until) in found.items():
+        if not fresh_until or fresh_until > now:
+            values[key] = value
+    missing = [key for key in keys if key not in values]
+    if missing:
+        built = build_multi(missing)
+        entries = {}
+        for key in missing:
+            value = built.get(key)
+            key_ttl = value is None and missing_ttl or ttl
+            entries[key] = (value, key_ttl and now + key_ttl)
+            # a batch shares one memcache expiry; tombstones carry their own
+            # fresh_until so they still go stale on time
+            local_cache.set(key, entries[key], key_ttl or None)
+            values[key] = value
+        memcache.set_multi(entries, time = ttl and ttl + STALE_GRACE)
+    return values
+
+### PAGE CACHE ###
+# A rendered response body with its compressed variants ({encoding:
+# bytes}), so compression runs once per version of the content instead of
+# once per request. The ETag comes from the key, see etag_for().
+Page = collections.namedtuple('Page', 'body encoded')
+
+def gzip_compress(body):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+# in order of preference
+COMPRESSORS = [('gzip', gzip_compress)]
+if brotli is not None:
+    COMPRESSORS.insert(0, ('br', brotli.compress))
+ENCODINGS = [encoding for encoding, compress in COMPRESSORS]
+
+def etag_for(key, encoding = None):
+    # only meaningful for versioned keys, see invalidation.py; every
+    # encoding of the body is a different representation with its own tag
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    if encoding:
+        return '"%s-%s"' % (digest, encoding)
+    return '"%s"' % digest
+
+def make_page(body):
+    if not isinstance(body, str):
+        body = body.encode('utf-8')
+    encoded = dict((encoding, compress(body)) for encoding, compress in COMPRESSORS)
+    return Page(body, encoded)
+
+def cached_page(key, render, ttl = ENTRY_TTL):
+    """The Page cached at key; render() returns its body on a miss."""
+    # under its own suffix: entries from when a Page also carried its ETag
+    # don't unpickle into the two-field Page
+    return cached(key + "|page", lambda: make_page(render()), ttl)
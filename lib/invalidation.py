@@ -0,0 +1,100 @@
+import time
+from google.appengine.api import memcache
+import cache_helpers
+from cache_helpers import cache_get, cache_delete
+
+# Which cache keys a post touches, so a write evicts only those instead of
+# flushing memcache. The cached entity and everything derived from it
+# (rendered pages, listings, the feed, the JSON export) are spread over many
+# keys, so those keys carry a version number: invalidating bumps the
+# version, nothing reads the old keys again and they age out of memcache
+# after ENTRY_TTL. Since a version changes exactly when the content does,
+# versioned keys double as ETags.
+
+LISTINGS = ('top', 'quote', 'feed', 'archive', 'json')
+
+def version_key(namespace):
+    return "version|%s" % namespace
+
+def _clock():
+    # a version that was evicted restarts from the clock, never from a
+    # number that was already handed out
+    return int(time.time() * 1000)
+
+def get_version(namespace):
+    key = version_key(namespace)
+    version = cache_get(key)
+    if version is None:
+        memcache.add(key, _clock())
+        version = memcache.get(key)
+    return version
+
+def versioned_key(namespace, *parts):
+    return "|".join([namespace, "v%s" % get_version(namespace)] + list(parts))
+
+def bump_version(namespace):
+    memcache.incr(version_key(namespace), initial_value = _clock())
+
+def post_namespace(post_id):
+    return "post-%s" % post_id
+
+# the entity shares its pages' version, so a page can't be rendered from
+# an entity of another version
+def post_entity_key(post_id):
+    return versioned_key(post_namespace(post_id), "entity")
+
+def post_page_key(post_id, logged_in):
+    return versioned_key(post_namespace(post_id), "html", str(int(logged_in)))
+
+def post_json_key(post_id):
+    return versioned_key(post_namespace(post_id), "json")
+
+def post_keys(post_id):
+    return ["(post_time, %s)" % post_id]
+
+def post_listings(post, is_new = False):
+    listings = ['quote' if post.is_quote else 'top', 'feed', 'json']
+    # sealed feed archives only hold months that are over, so a new post
+    # can't be in one
+    if not is_new:
+        listings.append('archive')
+    return listings
+
+def invalidate_post(post, was_public = False, is_new = False):
+    """Evict what depends on post; call after it was written or deleted.
+
+    Drafts only live under their own key, so the listings are left alone
+    unless the post is (or, before this write, was) published.
+    """
+    post_id = post.key().id()
+    for key in post_keys(post_id):
+        cache_delete(key)
+    bump_version(post_namespace(post_id))
+    if was_public or not post.is_draft:
+        for namespace in post_listings(post, is_new):
+            bump_version(namespace)
+    cache_helpers.bump_generation()
+
+def invalidate_listings():
+    for namespace in LISTINGS:
+        bump_version(namespace)
+    cache_helpers.bump_generation()
+
+def invalidate_rendering(post_id):
+    """After a post was re-rendered by a newer renderer: only its own pages
+    embed the HTML under its version, the listings are retired once for the
+    whole upgrade by renderer_changed().
+
+    Unlike invalidate_post() this leaves the generation alone, so other
+    instances can serve the old HTML until their local copy of the version
+    expires.
+    """
+    namespace = post_namespace(post_id)
+    bump_version(namespace)
+    cache_helpers.local_cache.delete(version_key(namespace))
+
+def renderer_changed(renderer):
+    # the first caller to see a new renderer retires the listings rendered
+    # by the old one; cheap enough to call on every instance start
+    if memcache.add("renderer|%s" % renderer, 1):
+        invalidate_listings()
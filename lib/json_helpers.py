@@ -0,0 +1,29 @@
+import json
+
+# Streaming JSON output: big arrays are encoded one element at a time so
+# nothing ever holds the whole document.
+
+def iter_json_array(items, indent = None):
+    """Yield the JSON text of a list of items in chunks, one per element.
+
+    indent works like json.dumps'; None gives the compact form.
+    """
+    if indent is None:
+        separators = (',', ':')
+        newline = ''
+    else:
+        separators = (',', ': ')
+        newline = '\n' + ' ' * indent
+    empty = True
+    yield '['
+    for item in items:
+        text = json.dumps(item, indent = indent, separators = separators)
+        text = newline + text.replace('\n', newline)
+        if empty:
+            empty = False
+            yield text
+        else:
+            yield ',' + text
+    if indent is not None and not empty:
+        yield '\n'
+    yield ']'
@@ -89,13 +89,11 @@ import sys
 from pprint import pprint
 import re
 import logging
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
+import itertools
 import optparse
 from random import random, randint
 import codecs
+import threading
 
 
 #---- Python version compat
@@ -134,9 +132,30 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
+# Text that later passes must not touch is swapped out for a key and
+# swapped back in at the end. A key is a random salt, so it can't be
+# guessed and written in a document, plus a count, so every key is new.
+# Keys keep the shape they had when they were md5 hexdigests: the regexes
+# see them as one word, wherever they are.
+SECRET_SALT = '%016x' % randint(0, 0xffffffffffffffff)
+if py3:
+    _next_hash_count = itertools.count().__next__
+else:
+    _next_hash_count = itertools.count().next
 def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+    return 'md5-%s%016x' % (SECRET_SALT, _next_hash_count())
+
+_hash_re = re.compile(r'md5-[0-9a-f]{32}')
+def _unhash_text(text, text_from_hash):
+    """Swap each key of `text_from_hash` in `text` back for its text, in
+    one pass. Other keys are left for their own tables."""
+    def _unhash_sub(match):
+        hash = match.group(0)
+        if hash not in text_from_hash:
+            return hash
+        # The text may have keys of its own, from before its key was made.
+        return _unhash_text(text_from_hash[hash], text_from_hash)
+    return _hash_re.sub(_unhash_sub, text)
 
 # Table of hash values for escaped characters:
 g_escape_table = dict([(ch, _hash_text(ch))
@@ -168,10 +187,10 @@ def markdown_path(path, encoding="utf-8",
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+    return _default_pool.convert(text, html4tags=html4tags,
+                                 tab_width=tab_width, safe_mode=safe_mode,
+                                 extras=extras, link_patterns=link_patterns,
+                                 use_file_vars=use_file_vars)
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -228,10 +247,11 @@ class Markdown(object):
         self.use_file_vars = use_file_vars
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
-        self._escape_table = g_escape_table.copy()
+        self._instance_escape_table = g_escape_table.copy()
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._instance_escape_table['"'] = _hash_text('"')
+            self._instance_escape_table["'"] = _hash_text("'")
+        self._escape_table = self._instance_escape_table.copy()
 
     def reset(self):
         self.urls = {}
@@ -239,7 +259,10 @@ class Markdown(object):
         self.html_blocks = {}
         self.html_spans = {}
         self.list_level = 0
+        self._toc = None
         self.extras = self._instance_extras.copy()
+        # _encode_code() adds the document's code spans to the table
+        self._escape_table = self._instance_escape_table.copy()
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -282,7 +305,8 @@ class Markdown(object):
                     self.extras[ename] = earg
 
         # Standardize line endings:
-        text = re.sub("\r\n|\r", "\n", text)
+        if "\r" in text:
+            text = re.sub("\r\n|\r", "\n", text)
 
         # Make sure $text ends with a couple of newlines:
         text += "\n\n"
@@ -294,7 +318,10 @@ class Markdown(object):
         # This makes subsequent regexen easier to write, because we can
         # match consecutive blank lines with /\n+/ instead of something
         # contorted like /[ \t]*\n+/ .
-        text = self._ws_only_line_re.sub("", text)
+        # (Tabs are gone and every line ends in a newline by now, so there
+        # is nothing to strip unless some line ends in a space.)
+        if " \n" in text:
+            text = self._ws_only_line_re.sub("", text)
 
         # strip metadata from head and extract
         if "metadata" in self.extras:
@@ -507,7 +534,12 @@ class Markdown(object):
         """
         if '\t' not in text:
             return text
-        return self._detab_re.subn(self._detab_sub, text)[0]
+        if '\r' in text:
+            # expandtabs() would restart the column at a '\r' too.
+            return self._detab_re.subn(self._detab_sub, text)[0]
+        # The same expansion, without `_detab_re` rescanning each tab-less
+        # line from every position in it.
+        return text.expandtabs(self.tab_width)
 
     # I broke out the html5 tags here and add them to _block_tags_a and
     # _block_tags_b.  This way html5 tags are easy to keep track of.
@@ -599,10 +631,14 @@ class Markdown(object):
         # the inner nested divs must be indented.
         # We need to do this before the next, more liberal match, because the next
         # match will start at the first `<div>` and stop at the first `</div>`.
-        text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
+        #
+        # Both only match a tag at the start of a line, so skip them unless
+        # there is one.
+        if text.startswith('<') or '\n<' in text:
+            text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
 
-        # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+            # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
+            text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
@@ -681,28 +717,9 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        if "]:" not in text:
+            return text
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -737,22 +754,9 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        if "[^" not in text:
+            return text
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
 
@@ -822,13 +826,7 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
-
+        _pyshell_block_re = _pyshell_block_re_from_tab_width(self.tab_width)
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
     def _wiki_table_sub(self, match):
@@ -857,12 +855,7 @@ class Markdown(object):
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _wiki_table_re_from_tab_width(self.tab_width)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
     def _run_span_gamut(self, text):
@@ -962,9 +955,7 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return _unhash_text(text, self.html_spans)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1275,7 +1266,8 @@ class Markdown(object):
         #
         #     Header 2
         #     --------
-        text = self._setext_h_re.sub(self._setext_h_sub, text)
+        if "\n=" in text or "\n-" in text:
+            text = self._setext_h_re.sub(self._setext_h_sub, text)
 
         # atx-style headers:
         #   # Header 1
@@ -1283,7 +1275,8 @@ class Markdown(object):
         #   ## Header 2 with closing hashes ##
         #   ...
         #   ###### Header 6
-        text = self._atx_h_re.sub(self._atx_h_sub, text)
+        if "#" in text:
+            text = self._atx_h_re.sub(self._atx_h_sub, text)
 
         return text
 
@@ -1305,42 +1298,27 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match. The HTML for each
+        # list goes into `pieces` instead of being spliced into `text`, so
+        # `text` never changes: a hit for one list style stays good until
+        # the other style's lists have been consumed up to it, and only
+        # then is that style searched for again.
+        pieces = []
         pos = 0
+        searches = []
+        for marker_pat in (self._marker_ul, self._marker_ol):
+            list_re = _list_re_from_tab_width(self.tab_width, marker_pat,
+                                              self.list_level > 0)
+            searches.append([list_re, list_re.search(text)])
         while True:
             # Find the *first* hit for either list style (ul or ol). We
             # match ul and ol separately to avoid adjacent lists of different
             # types running into each other (see issue #16).
             hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
+            for search in searches:
+                list_re, match = search
+                if match and match.start() < pos:
+                    match = search[1] = list_re.search(text, pos)
                 if match:
                     hits.append((match.start(), match))
             if not hits:
@@ -1348,10 +1326,12 @@ class Markdown(object):
             hits.sort()
             match = hits[0][1]
             start, end = match.span()
-            text = text[:start] + self._list_sub(match) + text[end:]
+            pieces.append(text[pos:start])
+            pieces.append(self._list_sub(match))
             pos = end
+        pieces.append(text[pos:])
 
-        return text
+        return ''.join(pieces)
 
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
@@ -1494,17 +1474,9 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        if ' ' * self.tab_width not in text and '\t' not in text:
+            return text
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
     _fenced_code_block_re = re.compile(r'''
@@ -1519,6 +1491,8 @@ class Markdown(object):
 
     def _do_fenced_code_blocks(self, text):
         """Process ```-fenced unindented code blocks ('fenced-code-blocks' extra)."""
+        if "```" not in text:
+            return text
         return self._fenced_code_block_re.sub(self._fenced_code_block_sub, text)
 
     # Rules for a code span:
@@ -1584,8 +1558,11 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
+        # The table is looked up by text, so the same text keeps its key.
+        hashed = self._escape_table.get(text)
+        if hashed is None:
+            hashed = _hash_text(text)
+            self._escape_table[text] = hashed
         return hashed
 
     _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
@@ -1767,7 +1744,9 @@ class Markdown(object):
         return text
 
     def _encode_backslash_escapes(self, text):
-        for ch, escape in list(self._escape_table.items()):
+        # Only the escapable characters: the code spans _encode_code()
+        # adds to the document's table aren't backslash escapes.
+        for ch, escape in list(self._instance_escape_table.items()):
             text = text.replace("\\"+ch, escape)
         return text
 
@@ -1842,15 +1821,13 @@ class Markdown(object):
                 hash = _hash_text(link)
                 link_from_hash[hash] = link
                 text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        return _unhash_text(text, link_from_hash)
 
     def _unescape_special_chars(self, text):
         # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        ch_from_hash = dict((hash, ch)
+                            for ch, hash in self._escape_table.items())
+        return _unhash_text(text, ch_from_hash)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -1872,6 +1849,77 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class MarkdownPool(object):
+    r"""A thread-safe pool of reusable Markdown converters.
+
+    `Markdown.convert()` keeps per-document state on the instance, so a
+    converter can only work on one document at a time. A pool hands every
+    `convert()` call an idle converter that was built with the same
+    options, or builds one if there is none, and takes it back afterwards.
+    The constructor's work (the extras dict, the escape table, the outdent
+    regex) is then done once per converter instead of once per document,
+    and threads can convert concurrently.
+
+        >>> pool = MarkdownPool()
+        >>> pool.convert("*boo!*", extras=["footnotes"])
+        u'<p><em>boo!</em></p>\n'
+
+    Options that can't be used as a dict key (e.g. an "html-classes"
+    extra given as a dict) get a fresh converter every time.
+    """
+    def __init__(self, markdown_class=Markdown, max_idle=8):
+        self.markdown_class = markdown_class
+        # idle converters kept per option set
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _options_key(self, options):
+        extras = options.get("extras") or ()
+        if isinstance(extras, dict):
+            extras = extras.items()
+        else:
+            extras = [(e, None) for e in extras]
+        key = dict(options)
+        key["extras"] = tuple(sorted(extras))
+        key["link_patterns"] = tuple(options.get("link_patterns") or ())
+        key = tuple(sorted(key.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def convert(self, text, **options):
+        key = self._options_key(options)
+        markdowner = None
+        if key is not None:
+            self._lock.acquire()
+            try:
+                idle = self._idle.get(key)
+                if idle:
+                    markdowner = idle.pop()
+            finally:
+                self._lock.release()
+        if markdowner is None:
+            markdowner = self.markdown_class(**options)
+        try:
+            return markdowner.convert(text)
+        finally:
+            # convert() starts with reset(), so a converter is reusable
+            # even if it failed half way
+            if key is not None:
+                self._lock.acquire()
+                try:
+                    idle = self._idle.setdefault(key, [])
+                    if len(idle) < self.max_idle:
+                        idle.append(markdowner)
+                finally:
+                    self._lock.release()
+
+_default_pool = MarkdownPool()
+
+
 #---- internal support functions
 
 class UnicodeWithAttrs(unicode):
@@ -2122,6 +2170,115 @@ def _hr_tag_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
+# The block-level patterns below only depend on the tab width (and, for
+# lists, on the markers and on whether the list is nested), so they are
+# compiled once per tab width rather than on every call.
+
+def _link_def_re_from_tab_width(tab_width):
+    """Link definitions: `[id]: url "optional title"`."""
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+def _footnote_def_re_from_tab_width(tab_width):
+    """Footnote definitions: `[^note-id]: Text of the note.`"""
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+def _pyshell_block_re_from_tab_width(tab_width):
+    """Python interactive shell sessions."""
+    return re.compile(r"""
+        ^([ ]{0,%d})>>>[ ].*\n   # first line
+        ^(\1.*\S+.*\n)*         # any number of subsequent lines
+        ^\n                     # ends with a blank line
+        """ % (tab_width - 1), re.M | re.X)
+_pyshell_block_re_from_tab_width = _memoized(_pyshell_block_re_from_tab_width)
+
+def _wiki_table_re_from_tab_width(tab_width):
+    """Google Code Wiki-style tables."""
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+        (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+        ''' % (tab_width - 1), re.M | re.X)
+_wiki_table_re_from_tab_width = _memoized(_wiki_table_re_from_tab_width)
+
+def _code_block_re_from_tab_width(tab_width):
+    """Indented `<pre><code>` blocks."""
+    return re.compile(r'''
+        (?:\n\n|\A\n?)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+_code_block_re_from_tab_width = _memoized(_code_block_re_from_tab_width)
+
+def _list_re_from_tab_width(tab_width, marker_pat, nested):
+    """A whole list whose items start with `marker_pat`. Nested lists may
+    start on any line, top-level ones only after a blank line."""
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+            (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (tab_width - 1, marker_pat, marker_pat)
+    if nested:
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    else:
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                          re.X | re.M | re.S)
+_list_re_from_tab_width = _memoized(_list_re_from_tab_width)
+
 
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""Time markdown2.py on big documents.
+<cases-dir> is a directory with a number of "*.text" files to process.
+
+The cases are joined into documents of JOIN cases each, so that the
+whole-document passes (detabbing, HTML block hashing, link definitions,
+headers, code blocks, ...) dominate rather than the per-call setup. Each
+size is timed with and without joining, for comparison.
+
+Example:
+    python gen_perf_cases.py    # generate a couple cases dirs
+    python big_docs.py -j 150 tmp-aspn-cases
+"""
+
+import os
+import sys
+import time
+from os.path import *
+from glob import glob
+import optparse
+
+sys.path.insert(0, join(dirname(abspath(__file__)), "..", "lib"))
+import markdown2
+
+
+clock = sys.platform == "win32" and time.clock or time.time
+
+def time_docs(docs, repeat):
+    markdowner = markdown2.Markdown()
+    times = []
+    for i in range(repeat):
+        start = clock()
+        for doc in docs:
+            markdowner.convert(doc)
+        end = clock()
+        times.append(end - start)
+    return min(times)
+
+
+#---- mainline
+
+class _NoReflowFormatter(optparse.IndentedHelpFormatter):
+    """An optparse formatter that does NOT reflow the description."""
+    def format_description(self, description):
+        return description or ""
+
+def main(args=sys.argv):
+    usage = "python big_docs.py [-r REPEAT] [-j JOIN] cases-dir"
+    parser = optparse.OptionParser(prog="big_docs", usage=usage,
+        description=__doc__, formatter=_NoReflowFormatter())
+    parser.add_option("-r", "--repeat", type="int",
+        help="number of times to repeat timing cycle (default 3)")
+    parser.add_option("-j", "--join", type="int",
+        help="number of cases per big document (default 100)")
+    parser.set_defaults(repeat=3, join=100)
+    opts, args = parser.parse_args(args[1:])
+
+    if len(args) != 1:
+        sys.stderr.write("error: incorrect number of args\n")
+        sys.stderr.write(__doc__)
+        return 1
+    cases_dir = args[0]
+    if not exists(cases_dir):
+        raise OSError("cases dir `%s' does not exist: use "
+                      "gen_perf_cases.py to generate some cases dirs"
+                      % cases_dir)
+
+    texts = []
+    for path in sorted(glob(join(cases_dir, "*.text"))):
+        f = open(path, 'r')
+        texts.append(f.read())
+        f.close()
+    docs = ["\n\n".join(texts[i:i+opts.join])
+            for i in range(0, len(texts), opts.join)]
+
+    print("Time conversion of %d files in %s:" % (len(texts), cases_dir))
+    small = time_docs(texts, opts.repeat)
+    big = time_docs(docs, opts.repeat)
+    print("  as %d documents: best of %d: %.3fs"
+          % (len(texts), opts.repeat, small))
+    print("  as %d documents (~%d bytes each): best of %d: %.3fs"
+          % (len(docs), sum(map(len, docs)) // len(docs), opts.repeat, big))
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Time markdown2.py on list-heavy documents of doubling size.
+
+Each generated document is made of N copies of a small pattern, for N
+doubling from the starting size. A linear-time conversion takes about
+twice as long for every doubling; a ratio nearer 4 means the time is
+going quadratic in the number of lists or items.
+
+Example:
+    python list_scaling.py
+    python list_scaling.py -n 1000 -s 5 many_lists
+"""
+
+import os
+import sys
+import time
+from os.path import *
+import optparse
+
+sys.path.insert(0, join(dirname(abspath(__file__)), "..", "lib"))
+import markdown2
+
+
+clock = sys.platform == "win32" and time.clock or time.time
+
+# name -> the pattern repeated N times
+PATTERNS = {
+    # many short lists, separated by paragraphs
+    "many_lists": "Para\n\n* a\n* b\n\n1. one\n2. two\n\n",
+    # bulleted and numbered lists back to back
+    "alternating": "* a\n\n1. b\n\n",
+    # one long tight list
+    "long_list": "* item\n",
+    # one long loose list
+    "loose_list": "* item\n\n",
+    # one long list, stepping eight deep over and over
+    "nested": "".join("    " * i + "* item\n" for i in range(8)),
+}
+
+def time_convert(text, repeat):
+    times = []
+    for i in range(repeat):
+        start = clock()
+        markdown2.markdown(text)
+        end = clock()
+        times.append(end - start)
+    return min(times)
+
+
+#---- mainline
+
+class _NoReflowFormatter(optparse.IndentedHelpFormatter):
+    """An optparse formatter that does NOT reflow the description."""
+    def format_description(self, description):
+        return description or ""
+
+def main(args=sys.argv):
+    usage = "python list_scaling.py [-r REPEAT] [-n SIZE] [-s STEPS] [patterns...]"
+    parser = optparse.OptionParser(prog="list_scaling", usage=usage,
+        description=__doc__, formatter=_NoReflowFormatter())
+    parser.add_option("-r", "--repeat", type="int",
+        help="number of times to repeat each conversion (default 3)")
+    parser.add_option("-n", "--size", type="int",
+        help="repetitions of the pattern to start with (default 500)")
+    parser.add_option("-s", "--steps", type="int",
+        help="number of times to double the size (default 4)")
+    parser.set_defaults(repeat=3, size=500, steps=4)
+    opts, args = parser.parse_args(args[1:])
+
+    names = args or sorted(PATTERNS)
+    for name in names:
+        if name not in PATTERNS:
+            sys.stderr.write("error: unknown pattern `%s' (one of: %s)\n"
+                             % (name, ", ".join(sorted(PATTERNS))))
+            return 1
+
+    for name in names:
+        print("%s:" % name)
+        last = None
+        for step in range(opts.steps + 1):
+            n = opts.size * 2 ** step
+            t = time_convert(PATTERNS[name] * n, opts.repeat)
+            if last:
+                print("  %7d: %.3fs (x%.1f)" % (n, t, t / last))
+            else:
+                print("  %7d: %.3fs" % (n, t))
+            last = t
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
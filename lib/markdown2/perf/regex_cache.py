@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""Time markdown2.py with and without its tables of tab-width regexes.
+<cases-dir> is a directory with a number of "*.text" files to process.
+
+The patterns for lists, code blocks, link and footnote definitions, wiki
+tables, pyshell blocks, <hr> and XML one-liners only depend on the tab
+width (and, for lists, the nesting), so markdown2 compiles each of them
+once per tab width into a memoized table. The "uncached" run swaps every
+table for the builder function it wraps, so each use formats and compiles
+its pattern again -- what the conversion methods used to do, with `re`'s
+own compile cache as the only shortcut.
+
+Example:
+    python gen_perf_cases.py    # generate a couple cases dirs
+    python regex_cache.py tmp-aspn-cases
+"""
+
+import os
+import sys
+import time
+from os.path import *
+from glob import glob
+import optparse
+
+sys.path.insert(0, join(dirname(abspath(__file__)), "..", "lib"))
+import markdown2
+
+
+clock = sys.platform == "win32" and time.clock or time.time
+
+def regex_tables():
+    """The names of markdown2's memoized regex builders."""
+    return sorted(name for name, value in vars(markdown2).items()
+                  if isinstance(value, markdown2._memoized)
+                  and name.endswith("_re_from_tab_width"))
+
+class _Counting(object):
+    """Calls the wrapped builder every time, counting the calls."""
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+    def __call__(self, *args):
+        self.calls += 1
+        return self.func(*args)
+
+def time_cases(texts, repeat, tab_width):
+    markdowner = markdown2.Markdown(tab_width=tab_width)
+    times = []
+    for i in range(repeat):
+        start = clock()
+        for text in texts:
+            markdowner.convert(text)
+        end = clock()
+        times.append(end - start)
+    return min(times)
+
+def time_uncached(texts, repeat, tab_width):
+    """Like time_cases() but with the tables bypassed; also returns how
+    many patterns were built per pass."""
+    tables = dict((name, getattr(markdown2, name)) for name in regex_tables())
+    counters = dict((name, _Counting(table.func))
+                    for name, table in tables.items())
+    try:
+        for name, counter in counters.items():
+            setattr(markdown2, name, counter)
+        best = time_cases(texts, repeat, tab_width)
+    finally:
+        for name, table in tables.items():
+            setattr(markdown2, name, table)
+    builds = sum(counter.calls for counter in counters.values()) // repeat
+    return best, builds
+
+
+#---- mainline
+
+class _NoReflowFormatter(optparse.IndentedHelpFormatter):
+    """An optparse formatter that does NOT reflow the description."""
+    def format_description(self, description):
+        return description or ""
+
+def main(args=sys.argv):
+    usage = "python regex_cache.py [-r REPEAT] [-t TAB_WIDTH] cases-dir"
+    parser = optparse.OptionParser(prog="regex_cache", usage=usage,
+        description=__doc__, formatter=_NoReflowFormatter())
+    parser.add_option("-r", "--repeat", type="int",
+        help="number of times to repeat timing cycle (default 3)")
+    parser.add_option("-t", "--tab-width", type="int",
+        help="tab width to convert with (default 4)")
+    parser.set_defaults(repeat=3, tab_width=4)
+    opts, args = parser.parse_args(args[1:])
+
+    if len(args) != 1:
+        sys.stderr.write("error: incorrect number of args\n")
+        sys.stderr.write(__doc__)
+        return 1
+    cases_dir = args[0]
+    if not exists(cases_dir):
+        raise OSError("cases dir `%s' does not exist: use "
+                      "gen_perf_cases.py to generate some cases dirs"
+                      % cases_dir)
+
+    texts = []
+    for path in sorted(glob(join(cases_dir, "*.text"))):
+        f = open(path, 'r')
+        texts.append(f.read())
+        f.close()
+
+    print("Time conversion of %d files in %s (tab width %d):"
+          % (len(texts), cases_dir, opts.tab_width))
+    uncached, builds = time_uncached(texts, opts.repeat, opts.tab_width)
+    cached = time_cases(texts, opts.repeat, opts.tab_width)
+    print("  uncached: best of %d: %.3fs (%d patterns built per pass)"
+          % (opts.repeat, uncached, builds))
+    print("  cached:   best of %d: %.3fs (%.1f%% faster, %.1fus per pattern)"
+          % (opts.repeat, cached, 100.0 * (uncached - cached) / uncached,
+             1e6 * (uncached - cached) / max(builds, 1)))
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
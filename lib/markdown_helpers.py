@@ -0,0 +1,28 @@
+import markdown2
+from markupsafe import Markup
+
+# Posts keep their markdown source next to the HTML rendered from it, and
+# the RENDERER_VERSION that rendered it. Bump RENDERER_VERSION whenever
+# markdown2 or the options below change: every stored rendering becomes
+# stale and each post is re-rendered the next time it is read, so an
+# upgrade rolls out without a bulk migration. It only ever goes up, so an
+# instance still running the old code never re-renders over a newer
+# rendering during a deploy.
+
+RENDERER_VERSION = 1
+EXTRAS = []
+
+def render(source):
+    return Markup(markdown2.markdown(source, extras = EXTRAS))
+
+def is_stale(post):
+    # posts from before sources were kept can't be re-rendered
+    return post.source is not None and (post.renderer or 0) < RENDERER_VERSION
+
+def refresh(post):
+    """Re-render post in place if its HTML is stale; True if it was."""
+    if not is_stale(post):
+        return False
+    post.content = render(post.source)
+    post.renderer = RENDERER_VERSION
+    return True
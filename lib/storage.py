@@ -0,0 +1,474 @@
+import os
+import sqlite3
+import datetime
+import threading
+import collections
+from google.appengine.ext import db
+
+# Pluggable storage for blog posts. The handlers only talk to a
+# PostRepository, so the blog can run against the App Engine datastore in
+# production and against a local SQLite file anywhere else.
+
+# What a listing page needs to know about a post. Listings cache these
+# instead of full posts so the (possibly huge) content never rides along.
+PostSummary = collections.namedtuple('PostSummary', 'id subject created is_quote')
+
+# list_page(fields=...) can leave out everything but these; created and the
+# id always come back because the cursor is built from them
+POST_FIELDS = ('subject', 'content', 'source', 'renderer', 'created', 'last_modified',
+               'is_draft', 'is_quote')
+
+def check_fields(fields):
+    for field in fields or ():
+        if field not in POST_FIELDS:
+            raise ValueError("unknown post field %r" % field)
+
+class PostRepository(object):
+    def create(self, **fields):
+        """Build a new, unsaved post."""
+        raise NotImplementedError
+
+    def get(self, post_id):
+        """Return the post with the given id, or None."""
+        raise NotImplementedError
+
+    def get_multi(self, post_ids):
+        """Return a list of posts (or None) lined up with post_ids."""
+        return [self.get(post_id) for post_id in post_ids]
+
+    def list_posts(self, is_draft = False, is_quote = None):
+        """Posts matching the flags, newest first. is_quote=None means both."""
+        raise NotImplementedError
+
+    def list_page(self, limit, cursor = None, is_draft = False, is_quote = None,
+                  fields = None):
+        """One page of list_posts() starting after cursor.
+
+        Returns (posts, next_cursor); next_cursor is None on the last page.
+        With fields, only those properties (see POST_FIELDS) are read.
+        """
+        raise NotImplementedError
+
+    def list_summary_page(self, limit, cursor = None, is_draft = False, is_quote = False):
+        """Like list_page() but returns PostSummary records."""
+        raise NotImplementedError
+
+    def list_range(self, start, end, limit = None, is_draft = False, is_quote = None):
+        """Posts created in [start, end), newest first. Either bound may be None."""
+        raise NotImplementedError
+
+    def iter_posts(self, batch_size, is_draft = False, is_quote = None, fields = None):
+        """Walk list_posts() one page-sized query at a time."""
+        cursor = None
+        while True:
+            posts, cursor = self.list_page(batch_size, cursor, is_draft, is_quote, fields)
+            for post in posts:
+                yield post
+            if cursor is None:
+                break
+
+    def put(self, post):
+        raise NotImplementedError
+
+    def save_rendering(self, post):
+        """Store post's re-rendered content and renderer stamp, nothing else.
+
+        Skipped if the post was edited since it was read (its source is no
+        longer the one that was rendered), so it can't undo the edit.
+        """
+        raise NotImplementedError
+
+    def save_renderings(self, posts):
+        """save_rendering() for a batch of posts, in as few writes as possible."""
+        for post in posts:
+            self.save_rendering(post)
+
+    def delete(self, post_id):
+        raise NotImplementedError
+
+### APP ENGINE DATASTORE ###
+class DatastorePostRepository(PostRepository):
+    def __init__(self, model):
+        self.model = model
+
+    def create(self, **fields):
+        return self.model(**fields)
+
+    def get(self, post_id):
+        return self.model.get_by_id(int(post_id))
+
+    def get_multi(self, post_ids):
+        return self.model.get_by_id([int(post_id) for post_id in post_ids])
+
+    def list_posts(self, is_draft = False, is_quote = None, projection = None,
+                   keys_only = False):
+        query = self.model.all(projection = projection, keys_only = keys_only)
+        query.filter('is_draft =', is_draft)
+        if is_quote is not None:
+            query.filter('is_quote =', is_quote)
+        return query.order('-created')
+
+    def list_page(self, limit, cursor = None, is_draft = False, is_quote = None,
+                  fields = None):
+        projection = _projection(fields)
+        def make_query(keys_only = False):
+            return self.list_posts(is_draft, is_quote,
+                                   None if keys_only else projection, keys_only)
+        return _split_page(_keyset_fetch(make_query, decode_cursor(cursor), limit),
+                           limit, _model_position)
+
+    def list_range(self, start, end, limit = None, is_draft = False, is_quote = None):
+        query = self.list_posts(is_draft, is_quote)
+        if start is not None:
+            query.filter('created >=', start)
+        if end is not None:
+            query.filter('created <', end)
+        if limit is None:
+            return list(query)
+        return query.fetch(limit)
+
+    def list_summary_page(self, limit, cursor = None, is_draft = False, is_quote = False):
+        # properties with an equality filter can't be projected, is_quote is
+        # known anyway. Needs the is_draft, is_quote, created, subject index.
+        def make_query(keys_only = False):
+            if keys_only:
+                query = self.model.all(keys_only = True)
+            else:
+                query = self.model.all(projection = ('subject', 'created'))
+            query.filter('is_draft =', is_draft).filter('is_quote =', is_quote)
+            return query.order('-created')
+        summaries = [PostSummary(post.key().id(), post.subject, post.created, is_quote)
+                     for post in _keyset_fetch(make_query, decode_cursor(cursor), limit)]
+        return _split_page(summaries, limit)
+
+    def put(self, post):
+        post.put()
+        return post
+
+    def save_rendering(self, post):
+        def update():
+            stored = self.get(post.key().id())
+            if stored is not None and stored.source == post.source:
+                stored.content = post.content
+                stored.renderer = post.renderer
+                stored.put()
+        db.run_in_transaction(update)
+
+    def save_renderings(self, posts):
+        # one batch get and put instead of a transaction per post; an edit
+        # racing with this is still caught unless it lands in between
+        stored = self.get_multi([post.key().id() for post in posts])
+        changed = []
+        for post, current in zip(posts, stored):
+            if current is not None and current.source == post.source:
+                current.content = post.content
+                current.renderer = post.renderer
+                changed.append(current)
+        db.put(changed)
+
+    def delete(self, post_id):
+        post = self.get(post_id)
+        if post is not None:
+            post.delete()
+
+def _projection(fields):
+    # content and source are unindexed and filtered properties can't be
+    # projected, so those need the whole entity. Each projection needs an index in
+    # index.yaml.
+    check_fields(fields)
+    if not fields or set(fields) & set(['content', 'source', 'is_draft', 'is_quote']):
+        return None
+    return ('created',) + tuple(sorted(set(fields) - set(['created'])))
+
+# Pages are in (created desc, id) order on both backends. The datastore has
+# no OR for "created < c or (created = c and id > i)", and the projection
+# indexes order posts created at the same time by their other properties,
+# so posts sharing a created time are read as a group and put in id order
+# here. make_query(keys_only = True) gives the same query without a
+# projection: a property can't be both projected and filtered on for
+# equality, so the group is looked up by key and then fetched whole.
+def _same_created(make_query, created):
+    keys = sorted(make_query(keys_only = True).filter('created =', created),
+                  key = lambda key: key.id())
+    return [post for post in db.get(keys) if post is not None]
+
+def _keyset_fetch(make_query, position, limit):
+    """At least limit + 1 posts after position if there are that many, in
+    page order, for _split_page()."""
+    posts = []
+    query = make_query()
+    if position:
+        created, post_id = position
+        posts = [post for post in _same_created(make_query, created)
+                 if _model_id(post) > post_id]
+        query.filter('created <', created)
+    if len(posts) > limit:
+        return posts
+    wanted = limit + 1 - len(posts)
+    rows = query.fetch(wanted)
+    if len(rows) == wanted:
+        # the oldest created time may continue past the fetch
+        boundary = rows[-1].created
+        rows = ([post for post in rows if post.created != boundary] +
+                _same_created(make_query, boundary))
+    rows.sort(key = _model_id)
+    rows.sort(key = lambda post: post.created, reverse = True)
+    return posts + rows
+
+### SQLITE ###
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# the two composite indexes mirror the ones in index.yaml
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS post (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject TEXT NOT NULL,
+    content TEXT NOT NULL,
+    source TEXT,
+    renderer INTEGER,
+    created TEXT NOT NULL,
+    last_modified TEXT NOT NULL,
+    is_draft INTEGER NOT NULL DEFAULT 0,
+    is_quote INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS post_draft_created
+    ON post (is_draft, created DESC);
+CREATE INDEX IF NOT EXISTS post_draft_quote_created
+    ON post (is_draft, is_quote, created DESC);
+CREATE INDEX IF NOT EXISTS post_listing
+    ON post (is_draft, is_quote, created DESC, subject);
+"""
+
+# columns added after the first schema; files created before them get them
+# with ALTER TABLE when they are opened
+ADDED_COLUMNS = [('source', 'TEXT'), ('renderer', 'INTEGER')]
+
+POST_COLUMNS = ("id, subject, content, source, renderer, created, last_modified, "
+                "is_draft, is_quote")
+
+# rows that share a timestamp are ordered by id so the keyset is total
+POST_ORDER = "ORDER BY created DESC, id ASC"
+
+class StoredKey(object):
+    __slots__ = ('_id',)
+
+    def __init__(self, post_id):
+        self._id = post_id
+
+    def id(self):
+        return self._id
+
+class StoredPost(object):
+    """A post row, shaped like the datastore Post model for the templates."""
+    def __init__(self, subject, content, source = None, renderer = None,
+                 created = None, last_modified = None, is_draft = False,
+                 is_quote = False, id = None):
+        self.id = id
+        self.subject = subject
+        self.content = content
+        self.source = source
+        self.renderer = renderer
+        self.created = created
+        self.last_modified = last_modified
+        self.is_draft = bool(is_draft)
+        self.is_quote = bool(is_quote)
+
+    def key(self):
+        return StoredKey(self.id)
+
+def _to_db(dt):
+    return dt.strftime(TIME_FORMAT)
+
+def _from_db(s):
+    return datetime.datetime.strptime(s, TIME_FORMAT)
+
+def _post_from_row(row):
+    return StoredPost(id = row[0], subject = row[1], content = row[2],
+                      source = row[3], renderer = row[4],
+                      created = _from_db(row[5]),
+                      last_modified = _from_db(row[6]),
+                      is_draft = row[7], is_quote = row[8])
+
+def _partial_post(fields):
+    """Columns to select for fields, and a row maker for them."""
+    check_fields(fields)
+    names = ['id', 'created'] + [f for f in POST_FIELDS if f in fields and f != 'created']
+    def make(row):
+        values = dict(zip(names, row))
+        for name in ('created', 'last_modified'):
+            if name in values:
+                values[name] = _from_db(values[name])
+        return StoredPost(values.pop('subject', None), values.pop('content', None),
+                          **values)
+    return ", ".join(names), make
+
+SUMMARY_COLUMNS = "id, subject, created, is_quote"
+
+def _summary_from_row(row):
+    return PostSummary(row[0], row[1], _from_db(row[2]), bool(row[3]))
+
+class SqlitePostRepository(PostRepository):
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        existing = set(row[1] for row in conn.execute("PRAGMA table_info(post)"))
+        for name, kind in ADDED_COLUMNS:
+            if name not in existing:
+                conn.execute("ALTER TABLE post ADD COLUMN %s %s" % (name, kind))
+        conn.commit()
+
+    def _conn(self):
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def create(self, **fields):
+        return StoredPost(**fields)
+
+    def get(self, post_id):
+        row = self._conn().execute("SELECT %s FROM post WHERE id = ?" % POST_COLUMNS,
+                                   (int(post_id),)).fetchone()
+        return row and _post_from_row(row)
+
+    def get_multi(self, post_ids):
+        post_ids = [int(post_id) for post_id in post_ids]
+        if not post_ids:
+            return []
+        rows = self._conn().execute("SELECT %s FROM post WHERE id IN (%s)"
+                                    % (POST_COLUMNS, ", ".join("?" * len(post_ids))),
+                                    post_ids).fetchall()
+        found = dict((row[0], _post_from_row(row)) for row in rows)
+        return [found.get(post_id) for post_id in post_ids]
+
+    def _select(self, is_draft, is_quote, position = None, limit = None,
+                columns = POST_COLUMNS, make = _post_from_row, start = None, end = None):
+        sql = "SELECT %s FROM post WHERE is_draft = ?" % columns
+        args = [int(bool(is_draft))]
+        if is_quote is not None:
+            sql += " AND is_quote = ?"
+            args.append(int(bool(is_quote)))
+        if start is not None:
+            sql += " AND created >= ?"
+            args.append(_to_db(start))
+        if end is not None:
+            sql += " AND created < ?"
+            args.append(_to_db(end))
+        if position:
+            # the plain created <= ? lets sqlite seek into the index
+            created = _to_db(position[0])
+            sql += " AND created <= ? AND (created < ? OR id > ?)"
+            args.extend([created, created, position[1]])
+        sql += " " + POST_ORDER
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        return [make(row) for row in self._conn().execute(sql, args)]
+
+    def list_posts(self, is_draft = False, is_quote = None):
+        return self._select(is_draft, is_quote)
+
+    def list_page(self, limit, cursor = None, is_draft = False, is_quote = None,
+                  fields = None):
+        if fields:
+            columns, make = _partial_post(fields)
+        else:
+            columns, make = POST_COLUMNS, _post_from_row
+        posts = self._select(is_draft, is_quote, decode_cursor(cursor), limit + 1,
+                             columns, make)
+        return _split_page(posts, limit)
+
+    def list_range(self, start, end, limit = None, is_draft = False, is_quote = None):
+        return self._select(is_draft, is_quote, limit = limit, start = start, end = end)
+
+    def list_summary_page(self, limit, cursor = None, is_draft = False, is_quote = False):
+        summaries = self._select(is_draft, is_quote, decode_cursor(cursor), limit + 1,
+                                 SUMMARY_COLUMNS, _summary_from_row)
+        return _split_page(summaries, limit)
+
+    def put(self, post):
+        now = datetime.datetime.now()
+        if post.created is None:
+            post.created = now
+        if post.last_modified is None:
+            post.last_modified = now
+        values = (post.subject, post.content, post.source, post.renderer,
+                  _to_db(post.created),
+                  _to_db(post.last_modified), int(post.is_draft),
+                  int(post.is_quote))
+        conn = self._conn()
+        with conn:
+            if post.id is None:
+                cursor = conn.execute("INSERT INTO post (subject, content, source, "
+                                      "renderer, created, last_modified, "
+                                      "is_draft, is_quote) "
+                                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values)
+                post.id = cursor.lastrowid
+            else:
+                conn.execute("UPDATE post SET subject = ?, content = ?, source = ?, "
+                             "renderer = ?, created = ?, last_modified = ?, "
+                             "is_draft = ?, is_quote = ? "
+                             "WHERE id = ?", values + (post.id,))
+        return post
+
+    def save_rendering(self, post):
+        self.save_renderings([post])
+
+    def save_renderings(self, posts):
+        conn = self._conn()
+        with conn:
+            conn.executemany("UPDATE post SET content = ?, renderer = ? "
+                             "WHERE id = ? AND source = ?",
+                             [(post.content, post.renderer, post.id, post.source)
+                              for post in posts])
+
+    def delete(self, post_id):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM post WHERE id = ?", (int(post_id),))
+
+### PAGINATION ###
+# Cursors are keysets on (created, id): "<created as digits>.<id>". Unlike
+# offsets they stay valid when newer posts are added in front of them.
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+def encode_cursor(created, post_id):
+    return "%s.%d" % (created.strftime(CURSOR_TIME_FORMAT), post_id)
+
+def decode_cursor(cursor):
+    """(created, id) for a cursor string; None if it is missing or bad."""
+    if not cursor:
+        return None
+    try:
+        created, post_id = cursor.split('.')
+        return datetime.datetime.strptime(created, CURSOR_TIME_FORMAT), int(post_id)
+    except ValueError:
+        return None
+
+def _row_position(post):
+    return post.created, post.id
+
+def _model_id(post):
+    return post.key().id()
+
+def _model_position(post):
+    return post.created, _model_id(post)
+
+def _split_page(posts, limit, position = _row_position):
+    # callers fetch one extra post to find out if there is a next page
+    posts = list(posts)
+    if len(posts) > limit:
+        posts = posts[:limit]
+        return posts, encode_cursor(*position(posts[-1]))
+    return posts, None
+
+# BLAG_STORAGE=sqlite:/path/to/blag.db switches off the datastore
+def make_repository(model):
+    backend = os.environ.get('BLAG_STORAGE', 'datastore')
+    if backend.startswith('sqlite:'):
+        return SqlitePostRepository(backend[len('sqlite:'):])
+    return DatastorePostRepository(model)
@@ -0,0 +1,50 @@
+import os
+import Queue
+import logging
+import threading
+
+# Background work that shouldn't hold up a request. On App Engine tasks go
+# through the deferred builtin (a push queue); anywhere else they run on a
+# small pool of threads inside the process. Tasks must be module-level
+# functions so that deferred can pickle them.
+
+class DeferredQueue(object):
+    def enqueue(self, fn, *args, **kwargs):
+        from google.appengine.ext import deferred
+        deferred.defer(fn, *args, **kwargs)
+
+class LocalQueue(object):
+    def __init__(self, workers = 4):
+        self._queue = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target = self._work, name = "task-worker-%d" % i)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            fn, args, kwargs = self._queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logging.exception("task %s failed", fn.__name__)
+            finally:
+                self._queue.task_done()
+
+    def enqueue(self, fn, *args, **kwargs):
+        self._queue.put((fn, args, kwargs))
+
+    def join(self):
+        """Wait until every queued task has run."""
+        self._queue.join()
+
+# BLAG_TASKS=local runs tasks in-process, e.g. next to the SQLite storage
+def make_queue():
+    if os.environ.get('BLAG_TASKS') == 'local':
+        return LocalQueue()
+    return DeferredQueue()
+
+queue = make_queue()
+
+def enqueue(fn, *args, **kwargs):
+    queue.enqueue(fn, *args, **kwargs)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Count backend queries per cache expiry under concurrent load.
+
+Starts a number of threads that all ask for the same key at the same
+moment, once with the plain get-then-set pattern the cache helpers used
+to have and once through cache_helpers.cached(), and reports how many
+times the (slow) backend query ran. Both a cold miss and a stale entry
+are tried.
+
+Needs the App Engine SDK on the path for the testbed memcache stub:
+
+    python perf/cache_stampede.py [-n THREADS]
+"""
+
+import os
+import sys
+import time
+import threading
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from google.appengine.ext import testbed
+from google.appengine.api import memcache
+import cache_helpers
+
+QUERY_TIME = 0.1
+
+class Backend(object):
+    def __init__(self):
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    def query(self):
+        with self.lock:
+            self.queries += 1
+        time.sleep(QUERY_TIME)
+        return ["post"] * 20
+
+def naive_get(key, backend):
+    value = memcache.get(key)
+    if value is None:
+        value = backend.query()
+        memcache.set(key, value)
+    return value
+
+def single_flight_get(key, backend):
+    return cache_helpers.cached(key, backend.query, ttl = 60)
+
+def hammer(getter, threads):
+    backend = Backend()
+    start = threading.Event()
+    def worker():
+        start.wait()
+        getter("top", backend)
+    workers = [threading.Thread(target = worker) for i in range(threads)]
+    for w in workers:
+        w.start()
+    start.set()
+    for w in workers:
+        w.join()
+    return backend.queries
+
+def reset():
+    memcache.flush_all()
+    cache_helpers.local_cache.clear()
+
+def expire():
+    # leave a value behind whose fresh_until has passed
+    reset()
+    memcache.set("top", (["post"] * 20, time.time() - 1))
+
+def main(args = sys.argv):
+    parser = optparse.OptionParser(usage = "python cache_stampede.py [-n THREADS]")
+    parser.add_option("-n", "--threads", type = "int", default = 50,
+                      help = "concurrent requests per expiry (default 50)")
+    opts, args = parser.parse_args(args[1:])
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    try:
+        print("%d concurrent requests, backend queries per expiry:" % opts.threads)
+        reset()
+        print("  cold miss, get-then-set:    %d" % hammer(naive_get, opts.threads))
+        reset()
+        print("  cold miss, single-flight:   %d" % hammer(single_flight_get, opts.threads))
+        expire()
+        print("  stale entry, single-flight: %d" % hammer(single_flight_get, opts.threads))
+    finally:
+        bed.deactivate()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
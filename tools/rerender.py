@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""Re-render every post whose HTML is older than RENDERER_VERSION.
+
+Reading a post re-renders it lazily anyway (see lib/markdown_helpers.py);
+this is for getting a whole archive done up front after bumping
+RENDERER_VERSION. Posts are walked a page at a time in keyset order,
+published and drafts in turn. Each page's stale sources are converted on
+a process pool and written back with one batched save, then the position
+is written to the checkpoint file, so an interrupted run carries on from
+the last finished page when it is started again:
+
+    BLAG_STORAGE=sqlite:blag.db python tools/rerender.py [-j WORKERS] [-b BATCH]
+
+Without BLAG_STORAGE it talks to the datastore, so it has to run where the
+datastore APIs are set up (e.g. in a remote_api shell, calling main()).
+Cached pages pick the new HTML up as posts are next read.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import optparse
+import multiprocessing
+
+from markupsafe import Markup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import blag
+import markdown_helpers
+
+DEFAULT_CHECKPOINT = "rerender.checkpoint"
+
+def render_source(source):
+    # runs in the pool; plain unicode pickles more cheaply than Markup
+    return unicode(markdown_helpers.render(source))
+
+def load_checkpoint(path):
+    """(is_draft, cursor) to resume from, or None to start over."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    return state['is_draft'], state['cursor']
+
+def save_checkpoint(path, is_draft, cursor):
+    # written aside and renamed so a crash can't leave half a file
+    with open(path + ".tmp", "w") as f:
+        json.dump({'is_draft': is_draft, 'cursor': cursor}, f)
+    os.rename(path + ".tmp", path)
+
+def rerender(repo, pool, batch_size, checkpoint):
+    """Returns (posts looked at, posts re-rendered)."""
+    resume = load_checkpoint(checkpoint)
+    seen = rendered = 0
+    start = time.time()
+    for is_draft in (False, True):
+        cursor = None
+        if resume:
+            if resume[0] != is_draft:
+                # the published posts were all done before the checkpoint
+                continue
+            cursor = resume[1]
+            resume = None
+        while True:
+            posts, next_cursor = repo.list_page(batch_size, cursor, is_draft = is_draft)
+            stale = [p for p in posts if markdown_helpers.is_stale(p)]
+            html = pool.map(render_source, [p.source for p in stale])
+            for post, content in zip(stale, html):
+                post.content = Markup(content)
+                post.renderer = markdown_helpers.RENDERER_VERSION
+            if stale:
+                repo.save_renderings(stale)
+            seen += len(posts)
+            rendered += len(stale)
+            if next_cursor is None:
+                break
+            cursor = next_cursor
+            save_checkpoint(checkpoint, is_draft, cursor)
+            elapsed = time.time() - start
+            logging.info("%d posts, %d re-rendered, %.1f posts/sec",
+                         seen, rendered, rendered / elapsed if elapsed else 0)
+        if not is_draft:
+            save_checkpoint(checkpoint, True, None)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return seen, rendered
+
+def main(argv = None):
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-j", "--workers", type = "int",
+                      default = multiprocessing.cpu_count(),
+                      help = "render processes (default: one per CPU)")
+    parser.add_option("-b", "--batch-size", type = "int", default = 200,
+                      help = "posts per page and per batched save")
+    parser.add_option("--checkpoint", default = DEFAULT_CHECKPOINT,
+                      help = "where to keep the position for resuming")
+    options, args = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")
+
+    pool = multiprocessing.Pool(options.workers)
+    start = time.time()
+    try:
+        seen, rendered = rerender(blag.post_repo, pool, options.batch_size,
+                                  options.checkpoint)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    print "re-rendered %d of %d posts in %.1fs (%.1f posts/sec)" % (
+        rendered, seen, elapsed, rendered / elapsed if elapsed else 0)
+
+if __name__ == "__main__":
+    main()